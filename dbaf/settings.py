@@ -82,6 +82,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # uploads are saved in one transaction, wait for it to finish
+        'OPTIONS': {'timeout': 60},
     }
 }
 
@@ -124,3 +126,11 @@ USE_TZ = True
 
 STATIC_URL = '/dbaf/static/'
 
+# Uploaded files waiting to be processed by the ingest_worker command
+
+UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads')
+
+# Number of processes parsing the datafiles of one upload
+
+UPLOAD_PARSE_WORKERS = os.cpu_count() or 1
+
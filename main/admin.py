@@ -14,3 +14,4 @@ admin.site.register(FlightFile)
 admin.site.register(Flight)
 admin.site.register(DeviceVersion)
 admin.site.register(Coefficient)
+admin.site.register(UploadJob)
@@ -0,0 +1,169 @@
+import csv
+import os
+import time
+from collections import OrderedDict, deque
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import DeviceVersion
+from main.upload import guess_dtype, parse_pool, submit_paths, save_paths
+
+
+# load archived flightfiles and datafiles from disk
+class Command(BaseCommand):
+    help = ("Ingest archived flight files and datafiles from a directory or "
+            "a manifest. In a directory, each folder holding one .csv flight "
+            "file is ingested with the other files of the folder, their "
+            "device type is guessed from the file name. A manifest is a csv "
+            "file with the columns flightfile, datafile and optionaly dtype, "
+            "version and year, paths are relative to the manifest.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="directory or manifest file")
+        parser.add_argument('--user', help="username owning the flight files")
+        parser.add_argument('--year', default="",
+                            help="year of the flight files without year")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="number of processes parsing datafiles")
+        parser.add_argument('--checkpoint', default="bulk_ingest.checkpoint",
+                            help="file listing the ingested flight files, "
+                                 "they are skipped when the command is run "
+                                 "again")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError("user %s does not exist" % options['user'])
+        if os.path.isdir(options['path']):
+            groups = self.walk(options['path'], options['year'])
+        else:
+            groups = self.read_manifest(options['path'], options['year'])
+        done = set()
+        if os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as f:
+                done = set(line.strip() for line in f)
+        tasks = [(flight_path, year, datafiles)
+                 for flight_path, (year, datafiles) in groups.items()
+                 if flight_path not in done]
+        self.stdout.write("%d flight file(s) to ingest, %d already done"
+                          % (len(tasks), len(groups) - len(tasks)))
+        # datafiles are parsed by the pool while this process saves the
+        # previous flight files, sqlite allows only one writer. A flight
+        # file is saved with its datafiles in one transaction just before
+        # it is added to the checkpoint, an interrupted run saves no
+        # flight file outside the checkpoint
+        pending = deque()
+        start = time.time()
+        self.nb_rows, self.nb_bytes, self.errors = 0, 0, 0
+        with open(options['checkpoint'], 'a') as checkpoint, \
+                parse_pool(options['workers'], options['workers']) as pool:
+            for flight_path, year, datafiles in tasks:
+                t = time.time()
+                try:
+                    flightfile, flights, parsed = submit_paths(
+                        pool, user, flight_path, year, datafiles)
+                    err = "Flight file wrong format"
+                except Exception as e:
+                    flightfile, err = None, ("unexpected error "
+                                             + type(e).__name__ + " " + str(e))
+                if (flightfile == None):
+                    self.errors += 1
+                    self.stderr.write("Error %s : %s" % (flight_path, err))
+                    continue
+                self.stdout.write(self.format_line(
+                    flight_path, len(flights),
+                    os.path.getsize(flight_path), time.time() - t))
+                pending.append((flight_path, flightfile, flights, parsed))
+                # parse the next flight files while saving this one
+                if len(pending) > options['workers']:
+                    self.save(checkpoint, *pending.popleft())
+            while pending:
+                self.save(checkpoint, *pending.popleft())
+        self.stdout.write(self.format_line("total", self.nb_rows,
+                                           self.nb_bytes, time.time() - start))
+        if self.errors:
+            raise CommandError("%d flight file(s) not ingested" % self.errors)
+
+    # save a flight file with its datafiles and add it to the checkpoint
+    def save(self, checkpoint, flight_path, flightfile, flights, parsed):
+        try:
+            report, err = save_paths(flightfile, flights, parsed)
+        except Exception as e:
+            report, err = [], ("unexpected error " + type(e).__name__ + " "
+                               + str(e))
+        for path, rows, seconds in report:
+            size = os.path.getsize(path)
+            if (err == None):
+                self.nb_rows += rows
+                self.nb_bytes += size
+            self.stdout.write(self.format_line(path, rows, size, seconds))
+        if (err != None):
+            self.errors += 1
+            self.stderr.write("Error %s : %s" % (flight_path, err))
+        else:
+            checkpoint.write(flight_path + "\n")
+            checkpoint.flush()
+
+    def format_line(self, path, rows, size, seconds):
+        seconds = max(seconds, 1e-6)
+        return ("%s : %d rows, %.2f MB in %.2f s (%.0f rows/s, %.2f MB/s)"
+                % (path, rows, size / 1e6, seconds, rows / seconds,
+                   size / 1e6 / seconds))
+
+    # return {flight path : (year, [(datafile path, dtype, None), ...])}
+    def walk(self, root, year):
+        groups = OrderedDict()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            filenames = sorted(f for f in filenames if not f.startswith('.'))
+            flightfiles = [f for f in filenames if f.lower().endswith('.csv')]
+            if len(flightfiles) != 1:
+                if len(flightfiles) > 1:
+                    self.stderr.write("Skip %s : more than one flight file"
+                                      % dirpath)
+                continue
+            datafiles = []
+            for filename in filenames:
+                if filename == flightfiles[0]:
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                dtype = guess_dtype(filename)
+                if dtype is None:
+                    self.stderr.write("Skip %s : unknown device" % path)
+                    continue
+                datafiles.append((path, dtype, None))
+            flight_path = os.path.abspath(os.path.join(dirpath,
+                                                       flightfiles[0]))
+            groups[flight_path] = (year, datafiles)
+        return groups
+
+    # return {flight path : (year, [(datafile path, dtype, version id), ...])}
+    def read_manifest(self, manifest, year):
+        root = os.path.dirname(os.path.abspath(manifest))
+        groups = OrderedDict()
+        with open(manifest, newline='') as f:
+            for row in csv.DictReader(f):
+                flight_path = os.path.abspath(os.path.join(root,
+                                                           row['flightfile']))
+                group = groups.setdefault(flight_path,
+                                          (row.get('year') or year, []))
+                if not row.get('datafile'):
+                    continue
+                path = os.path.abspath(os.path.join(root, row['datafile']))
+                dtype = (row.get('dtype')
+                         or guess_dtype(os.path.basename(path)))
+                if dtype is None:
+                    raise CommandError("unknown device of %s" % path)
+                version = None
+                if row.get('version'):
+                    version = DeviceVersion.objects.filter(
+                        dtype=dtype, version=row['version']).first()
+                    if version is None:
+                        raise CommandError("version %s of %s does not exist"
+                                           % (row['version'], dtype))
+                    version = version.id
+                group[1].append((path, dtype, version))
+        return groups
@@ -0,0 +1,41 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main.models import UploadJob
+from main.upload import work
+
+
+# process the uploads staged by the upload and view_flights pages
+class Command(BaseCommand):
+    help = "Process pending upload jobs with a pool of local workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help="number of worker processes")
+        parser.add_argument('--sleep', type=float, default=2,
+                            help="seconds to wait when no job is pending")
+        parser.add_argument('--once', action='store_true',
+                            help="exit when no job is pending")
+        parser.add_argument('--requeue', action='store_true',
+                            help="set running jobs (of a stopped worker) "
+                                 "back to pending before starting")
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            nb = UploadJob.objects.filter(status="running") \
+                .update(status="pending")
+            self.stdout.write("%d job(s) requeued" % nb)
+        if options['workers'] <= 1:
+            work(options['sleep'], options['once'])
+            return
+        # each process opens its own database connection
+        connections.close_all()
+        workers = [multiprocessing.Process(
+                       target=work, args=(options['sleep'], options['once']))
+                   for i in range(options['workers'])]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
@@ -0,0 +1,58 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import numpy
+
+
+# spectrum stored as channel counts packed as little-endian uint32
+# instead of a ';' separated string
+
+def text_to_binary(apps, schema_editor):
+    DataLiulin = apps.get_model('main', 'DataLiulin')
+    data = []
+    for d in DataLiulin.objects.only('spectrum').iterator(chunk_size=2000):
+        d.spectrum_bin = numpy.array(
+            d.spectrum.split(';'), dtype=numpy.int64).astype('<u4').tobytes()
+        data.append(d)
+        if len(data) == 2000:
+            DataLiulin.objects.bulk_update(data, ['spectrum_bin'])
+            data = []
+    DataLiulin.objects.bulk_update(data, ['spectrum_bin'])
+
+
+def binary_to_text(apps, schema_editor):
+    DataLiulin = apps.get_model('main', 'DataLiulin')
+    data = []
+    for d in DataLiulin.objects.only('spectrum_bin').iterator(chunk_size=2000):
+        counts = numpy.frombuffer(d.spectrum_bin, dtype='<u4')
+        d.spectrum = ';'.join(map(str, counts.tolist()))
+        data.append(d)
+        if len(data) == 2000:
+            DataLiulin.objects.bulk_update(data, ['spectrum'])
+            data = []
+    DataLiulin.objects.bulk_update(data, ['spectrum'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_flightfile_user_fk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataliulin',
+            name='spectrum_bin',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(text_to_binary, binary_to_text),
+        migrations.RemoveField(
+            model_name='dataliulin',
+            name='spectrum',
+        ),
+        migrations.RenameField(
+            model_name='dataliulin',
+            old_name='spectrum_bin',
+            new_name='spectrum',
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_dataliulin_spectrum_binary'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='flight',
+            name='time_off',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='dataepdn2',
+            index=models.Index(fields=['file_fk', 'flight_fk', 'time'], name='main_dataep_file_fk_7d1ce9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='datahawk',
+            index=models.Index(fields=['file_fk', 'flight_fk', 'time'], name='main_dataha_file_fk_7f738e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dataliulin',
+            index=models.Index(fields=['file_fk', 'flight_fk', 'time'], name='main_datali_file_fk_8a2098_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='integrateddose',
+            index=models.Index(fields=['flight_fk', 'datafile_fk'], name='main_integr_flight__cea37e_idx'),
+        ),
+    ]
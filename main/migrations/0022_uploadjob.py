@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0021_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('flight_filename', models.CharField(blank=True, max_length=255)),
+                ('year', models.CharField(blank=True, max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('error', 'error')], default='pending', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('flight_file_fk', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.FlightFile')),
+                ('user_fk', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadJobFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('dtype', models.CharField(choices=[('DataEPDN2', 'EPDN2'), ('DataLiulin', 'Liulin'), ('DataHawk', 'Hawk')], max_length=255)),
+                ('job_fk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.UploadJob')),
+                ('version_fk', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.DeviceVersion')),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_uploadjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoseRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series', models.BinaryField()),
+                ('datafile_fk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.DataFile')),
+                ('flight_fk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Flight')),
+            ],
+            options={
+                'unique_together': {('datafile_fk', 'flight_fk')},
+            },
+        ),
+    ]
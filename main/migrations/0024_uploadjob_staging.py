@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_doserate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadjob',
+            name='status',
+            field=models.CharField(choices=[('staging', 'staging'), ('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('error', 'error')], default='pending', max_length=16),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0025_uploadjob_coefficient'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataepdn2',
+            index=models.Index(fields=['file_fk', 'time'], name='main_dataep_file_fk_46f4b1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='datahawk',
+            index=models.Index(fields=['file_fk', 'time'], name='main_dataha_file_fk_12c482_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dataliulin',
+            index=models.Index(fields=['file_fk', 'time'], name='main_datali_file_fk_88daa4_idx'),
+        ),
+    ]
@@ -1,30 +1,92 @@
 import datetime as dt
 import pytz
 import os
+import io
+import time
+import bisect
+import zlib
 import itertools
-from operator import add
 from decimal import *
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Sum, F, Value
+from django.db import models, connection, transaction, DatabaseError
+from django.db.models import Sum, Max, F, Value, Func
 import pandas
 import numpy as np
 
 from .utils import *
 
 
-def getFlightAt(flights, time):
-    f = list(filter(lambda x: time >= x.time_off
-                              and time <= x.time_on, flights))
-    if len(f) == 0:
-        return None
-    else:
-        return f[0]
+# sorted interval index on [time_off, time_on] of a list of flights
+# flights of one flightfile are assumed not to overlap
+# the flights can be unsaved, positions in self.flights are the same for
+# the index of the saved flights in the same order
+class FlightIndex:
+    def __init__(self, flights):
+        self.flights = sorted(flights, key=lambda f: f.time_off)
+        self.off = toDatetime64([f.time_off for f in self.flights])
+        self.on = toDatetime64([f.time_on for f in self.flights])
+
+    # return the numpy array of positions in self.flights of the flight
+    # containing each date of times, -1 for dates out of any flight
+    def at(self, times):
+        times = toDatetime64(times)
+        if len(self.flights) == 0:
+            return np.full(len(times), -1)
+        idx = np.searchsorted(self.off, times, side='right') - 1
+        found = (idx >= 0) & (times <= self.on[idx.clip(0)])
+        return np.where(found, idx, -1)
+
+    # return the list of Flight (or None) at positions returned by at
+    def get(self, positions):
+        flights = np.empty(len(self.flights) + 1, dtype=object)
+        flights[:-1] = self.flights
+        return flights[positions].tolist()
+
+
+# max number of rows inserted by each query of bulkCreate
+batchSize = 1000
+
+
+# bulk_create objs of model by batches of at most batchSize rows
+# django 2.2 does not bound an explicit batch_size by the database limits
+def bulkCreate(model, objs):
+    objs = list(objs)
+    fields = [f for f in model._meta.concrete_fields
+              if not isinstance(f, models.AutoField)]
+    size = connection.ops.bulk_batch_size(fields, objs) or batchSize
+    return model.objects.bulk_create(objs, batch_size=min(size, batchSize))
+
+
+# return the fields of a queryset as columns : dates as numpy arrays of
+# seconds since date t0, binaries as lists and numbers as float arrays
+def getColumns(data, fields, t0):
+    rows = list(data.values_list(*fields))
+    columns = []
+    for idx, name in enumerate(fields):
+        field = data.model._meta.get_field(name)
+        col = [row[idx] for row in rows]
+        if isinstance(field, models.DateTimeField):
+            columns.append(secondsSince(col, t0))
+        elif isinstance(field, models.BinaryField):
+            columns.append(col)
+        else:
+            columns.append(np.array(col, dtype=float))
+    return columns
+
+
+# IntegratedDose of a dict of summed doses {'bas' : .., 'haut' : ..}
+# and optionaly 'flight_fk'
+def sumDoses(sums):
+    bLET = sums['bas'] or 0
+    hLET = sums['haut'] or 0
+    return IntegratedDose(flight_fk_id=sums.get('flight_fk'),
+                          dose=(bLET + hLET), bas_LET=bLET, haut_LET=hLET)
 
 
 # abstact model for data of all device
-# child class must implement save_file, get_serial_num, integrate_dose
+# child class must implement parse_file, get_serial_num, integrate_dose
 # and have attr metadata
 class AData(models.Model):
     file_fk = models.ForeignKey('DataFile', on_delete=models.CASCADE)
@@ -49,17 +111,53 @@ class AData(models.Model):
     def get_serial_num(file_):
         raise NotImplemented
 
-    # parse file and save data in db, can throw
-    def save_file(datafile, file_):
+    # parse file without database access (can run in another process)
+    # flights = FlightIndex of the flight file (saved or not), can throw
+    # return dict of columns (numpy arrays or lists) : 'time', 'flight'
+    # (positions returned by flights.at) and one for each field of the model
+    def parse_file(file_, flights):
         raise NotImplemented
 
-    # integrate dose of data list return IntegratedDose or None
+    # save in db the columns returned by parse_file for datafile, once the
+    # flights of its flight file are saved
+    def save_columns(datafile, columns):
+        model = deviceDict[datafile.device_fk.dtype]
+        columns = dict(columns)
+        columns["flight_fk"] = datafile.flight_file_fk.flight_index().get(
+            columns.pop("flight"))
+        names = list(columns)
+        values = [col.tolist() if isinstance(col, np.ndarray) else col
+                  for col in columns.values()]
+        bulkCreate(model, (model(file_fk=datafile, **dict(zip(names, row)))
+                           for row in zip(*values)))
+
+    # integrate dose of data (list of AData of one flight ordered by time)
+    # return IntegratedDose or None
     def integrate_dose(data):
         raise NotImplemented
 
-    # data = list of AData, time = fligth.time_off
-    # return {'time' : ['0000-01-01 00:00:34', ...],
-    #       'bas' : [...], 'haut' : .[..], 'total' : [...]}
+    # integrate dose of a queryset of one datafile for each flight
+    # return list of IntegratedDose with flight_fk_id set
+    def integrate_flights(data):
+        idoses = []
+        data = data.exclude(flight_fk=None).order_by('flight_fk', 'time')
+        for flight, rows in itertools.groupby(data.iterator(),
+                                              key=lambda d: d.flight_fk_id):
+            idose = data.model.integrate_dose(list(rows))
+            if idose is not None:
+                idose.flight_fk_id = flight
+                idoses.append(idose)
+        return idoses
+
+    # recompute the columns depending on the Coefficient of device for its
+    # data measured from date start to the start of the next coefficient
+    # return the queryset of the updated rows
+    def calibrate(device, start):
+        return deviceDict[device.dtype].objects.none()
+
+    # data = queryset of AData ordered by time, time = fligth.time_off
+    # return numpy arrays {'time' : seconds since time,
+    #       'bas' : µSv/h, 'haut' : µSv/h, 'total' : µSv/h}
     def dose_rate(data, time):
         raise NotImplemented
 
@@ -68,6 +166,11 @@ class AData(models.Model):
 
     class Meta:
         abstract = True
+        indexes = [
+            models.Index(fields=['file_fk', 'flight_fk', 'time']),
+            # rows of a datafile in time order (view_data pages)
+            models.Index(fields=['file_fk', 'time']),
+        ]
 
 
 class DataEPDN2(AData):
@@ -86,71 +189,70 @@ class DataEPDN2(AData):
     def get_serial_num(file_):
         return os.path.splitext(file_.name)[0]
 
-    def save_file(datafile, file_):
-        data = []
+    def parse_file(file_, flights):
         df = pandas.read_csv(file_, skipinitialspace=True, encoding="utf-16le")
-        date = dt.datetime.strptime(df["DateHeure"][len(df.index) - 1],
-                                    "%d/%m/%Y %H:%M:%S")
-        utc_off = pytz.timezone("Europe/Paris").localize(date).utcoffset()
-        flights = datafile.flight_file_fk.flight_set.all()
-        for idx in range(len(df.index) - 2, -1, -1):
-            date = dt.datetime.strptime(df["DateHeure"][idx],
-                                        "%d/%m/%Y %H:%M:%S")
-            time = (date - utc_off).replace(tzinfo=pytz.utc)
-            gamma = df["HpG uSv"][idx] - df["HpG uSv"][idx + 1]
-            neutron = df["HpN uSv"][idx] - df["HpN uSv"][idx + 1]
-            if gamma > 0 or neutron > 0:
-                data.append(DataEPDN2(
-                    file_fk=datafile, flight_fk=getFlightAt(flights, time),
-                    time=time, gamma=gamma, neutron=neutron))
-        DataEPDN2.objects.bulk_create(data)   
+        # file is in reverse chronological order with cumulated doses
+        df = df.iloc[::-1].reset_index(drop=True)
+        dates = pandas.to_datetime(df["DateHeure"], format="%d/%m/%Y %H:%M:%S")
+        times = localToUtc(dates, dates[0].to_pydatetime())
+        gamma = df["HpG uSv"].diff().fillna(0).astype(df["HpG uSv"].dtype)
+        neutron = df["HpN uSv"].diff().fillna(0).astype(df["HpN uSv"].dtype)
+        mask = (gamma > 0) | (neutron > 0)
+        times = times[mask]
+        return {"time" : times.dt.to_pydatetime(),
+                "flight" : flights.at(times),
+                "gamma" : gamma[mask].values,
+                "neutron" : neutron[mask].values}
 
     def integrate_dose(data):
-        bLET = 0
-        hLET = 0
-        for d in data:
-            bLET += d.gamma
-            hLET += d.neutron
-        return IntegratedDose(dose=(bLET + hLET), bas_LET=bLET, haut_LET=hLET)
+        return sumDoses({'bas' : sum(d.gamma for d in data),
+                         'haut' : sum(d.neutron for d in data)})
+
+    def integrate_flights(data):
+        sums = data.exclude(flight_fk=None).order_by().values('flight_fk') \
+            .annotate(bas=Sum('gamma'), haut=Sum('neutron'))
+        return [sumDoses(s) for s in sums]
 
     def dose_rate(data, time):
-        prev_bas = time
-        prev_haut = time
-        rate = {'time' : [], 'bas' : [], 'haut' : [], 'total' : []}
-        xb = []
-        yb = []
-        xh = []
-        yh = []
-        x = []
-        for d in data:
-            bas = None
-            haut = None
-            t = d.time - time
-            if d.gamma != 0:
-
-                if prev_bas != time:
-                    time_diff = (d.time - prev_bas).total_seconds()
-                    yb.append(d.gamma / (time_diff / 3600))
-                    xb.append(t.total_seconds())
-                prev_bas = d.time
-            if d.neutron != 0:
-                if prev_haut != time:
-                    time_diff = (d.time - prev_haut).total_seconds()
-                    yh.append(d.neutron / (time_diff / 3600))
-                    xh.append(t.total_seconds())
-                prev_haut = d.time
-            x.append(t.total_seconds())
-            rate['time'].append('0000-01-01 ' + str(t))
-        rate['bas'] = np.interp(x, xb, yb).tolist()
-        rate['haut'] = np.interp(x, xh, yh).tolist()
-        rate['total'] = list(map(add, rate['bas'], rate['haut']))
+        x, gamma, neutron = getColumns(data, ["time", "gamma", "neutron"],
+                                       time)
+        rate = {'time' : x}
+        # rate at each non zero measure, interpolated for other times
+        for key, dose in (('bas', gamma), ('haut', neutron)):
+            idx = np.flatnonzero(dose)
+            xp = x[idx[1:]]
+            fp = dose[idx[1:]] / (np.diff(x[idx]) / 3600)
+            rate[key] = np.interp(x, xp, fp) if len(xp) else np.zeros(len(x))
+        rate['total'] = rate['bas'] + rate['haut']
         return rate
-       
+
+
+# energy deposited in each of the 256 channels of a Liulin spectrum
+# column 0 : low LET (channels 1 to 12), column 1 : high LET (13 to 255)
+liulinLET = np.zeros((256, 2))
+liulinLET[1:13, 0] = 40.7 + 81.4 * np.arange(0, 12)
+liulinLET[13:, 1] = 40.7 + 81.4 * np.arange(12, 255)
+
+
+# return the (N x 2) low and high LET deposits of a (N x 256) matrix of
+# channel counts
+def letDeposits(spectra):
+    return spectra[:, :256] @ liulinLET
+
+
+# return the low and high LET fractions of each row of deposits
+# (0 for rows without any deposit)
+def letFractions(deposits):
+    total = deposits.sum(axis=1, keepdims=True)
+    return np.divide(deposits, total, out=np.zeros_like(deposits),
+                     where=(total != 0))
+
 
 class DataLiulin(AData):
     dose = models.DecimalField(max_digits=14, decimal_places=7)
     flux = models.DecimalField(max_digits=14, decimal_places=7)
-    spectrum = models.TextField(default=0)
+    # channel counts packed as little-endian uint32
+    spectrum = models.BinaryField(default=b'')
     
     metadata = {
         "name" : "Liulin",
@@ -161,73 +263,84 @@ class DataLiulin(AData):
         ]
     }
 
+    spectrumType = np.dtype('<u4')
+
+    # return the channel counts as a numpy array (view on stored bytes)
+    def spectrum_counts(self):
+        return np.frombuffer(self.spectrum, dtype=DataLiulin.spectrumType)
+
     def get_serial_num(file_):
         header = file_.readline().decode('ascii').split(' ')
         file_.seek(0, 0)
         return header[0]
 
-    def save_file(datafile, file_):
-        data = []
-        df = pandas.read_csv(file_, delim_whitespace=True, skiprows=2, header=None)
-        date = dt.datetime.strptime(df[0][1] + " " + df[1][1],
-                                    "%d/%m/%y %H:%M:%S")
-        utc_off = pytz.timezone("Europe/Paris").localize(date).utcoffset()
-        flights = datafile.flight_file_fk.flight_set.all()
-        file_.seek(0, 0)
-        file_.readline()
-        file_.readline()
-        for idx in range(0, len(df.index) - 1, 2):
-            spec = file_.readline().decode('ascii').strip().replace(" ", ";")
-            file_.readline()
-            date = dt.datetime.strptime(df[0][idx + 1] + " " + df[1][idx + 1],
-                                        "%d/%m/%y %H:%M:%S")
-            time = (date - utc_off).replace(tzinfo=pytz.utc)
-            data.append(DataLiulin(
-                file_fk=datafile, flight_fk=getFlightAt(flights, time),
-                time=time, dose=df[4][idx + 1],
-                flux=df[7][idx + 1], spectrum=spec
-                ))
-        DataLiulin.objects.bulk_create(data)
-
-    def integrate_dose(data):
-        bLET = 0
-        hLET = 0
-        tot = 0
-        if len(data) < 2:
+    def parse_file(file_, flights):
+        # after 2 header lines, lines alternate between spectrum and summary
+        lines = file_.read().decode('ascii').splitlines()[2:]
+        nb = len(lines) // 2
+        spectra = pandas.read_csv(io.StringIO("\n".join(lines[0:2 * nb:2])),
+                                  delim_whitespace=True, header=None,
+                                  dtype=np.int64).values
+        spectra = spectra.astype(DataLiulin.spectrumType)
+        df = pandas.read_csv(io.StringIO("\n".join(lines[1:2 * nb:2])),
+                             delim_whitespace=True, header=None)
+        dates = pandas.to_datetime(df[0] + " " + df[1],
+                                   format="%d/%m/%y %H:%M:%S")
+        times = localToUtc(dates, dates[0].to_pydatetime())
+        return {"time" : times.dt.to_pydatetime(),
+                "flight" : flights.at(times),
+                "dose" : df[4].values, "flux" : df[7].values,
+                "spectrum" : [spec.tobytes() for spec in spectra]}
+
+    # return the (N x 256) matrix of a list of packed spectra
+    def spectra_matrix(spectra):
+        if len(spectra) == 0:
+            return np.zeros((0, 256), dtype=DataLiulin.spectrumType)
+        counts = np.frombuffer(b''.join(spectra), dtype=DataLiulin.spectrumType)
+        return counts.reshape(len(spectra), -1)
+
+    # IntegratedDose of measures at times x (seconds) with dose rates doses
+    # and channel counts spectra, exposure time is the first time step
+    def integrate_arrays(x, doses, spectra):
+        if len(x) < 2:
             return None
-        expo = data[1].time - data[0].time
-        for d in data:
-            channels = d.spectrum.split(';')
-            tot += float(d.dose) * (expo.total_seconds() / 3600)
-            for i in range(1, 256):
-                if i <= 12:
-                    bLET += int(channels[i]) * (40.7 + 81.4 * (i - 1))
-                else:
-                    hLET += int(channels[i]) * (40.7 + 81.4 * (i - 1))
+        tot = (doses * ((x[1] - x[0]) / 3600)).sum()
+        bLET, hLET = letDeposits(spectra).sum(axis=0)
         tLET = bLET + hLET
+        if tLET == 0:
+            return IntegratedDose(dose=tot)
         return IntegratedDose(dose=tot, bas_LET=(bLET / tLET * tot),
                               haut_LET=(hLET / tLET * tot))
+
+    def integrate_dose(data):
+        if len(data) == 0:
+            return None
+        return DataLiulin.integrate_arrays(
+            secondsSince([d.time for d in data], data[0].time),
+            np.array([float(d.dose) for d in data]),
+            np.vstack([d.spectrum_counts() for d in data]))
+
+    def integrate_flights(data):
+        data = data.exclude(flight_fk=None).order_by('flight_fk', 'time')
+        flights, x, doses, spectra = getColumns(
+            data, ["flight_fk", "time", "dose", "spectrum"], epoch)
+        spectra = DataLiulin.spectra_matrix(spectra)
+        bounds = np.flatnonzero(np.diff(flights)) + 1
+        idoses = []
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(x)]):
+            idose = DataLiulin.integrate_arrays(
+                x[start:end], doses[start:end], spectra[start:end])
+            if idose is not None:
+                idose.flight_fk_id = int(flights[start])
+                idoses.append(idose)
+        return idoses
     
     def dose_rate(data, time):
-        rate = {'time' : [], 'total' : [], 'bas' : [], 'haut' : []}
-        for d in data:
-            channels = d.spectrum.split(';')
-            bLET = 0
-            hLET = 0
-            for i in range(1, 256):
-                if i <= 12:
-                    bLET += int(channels[i]) * (40.7 + 81.4 * (i - 1))
-                else:
-                    hLET += int(channels[i]) * (40.7 + 81.4 * (i - 1))
-            tLET = bLET + hLET
-            rate['time'].append('0000-01-01 ' + str(d.time - time))
-            rate['total'].append(d.dose)
-            rate['bas'].append(float(d.dose) * (bLET / tLET))
-            rate['haut'].append(float(d.dose) * (hLET / tLET))
-        return rate
- 
-
-
+        x, doses, spectra = getColumns(data, ["time", "dose", "spectrum"],
+                                       time)
+        let = letFractions(letDeposits(DataLiulin.spectra_matrix(spectra)))
+        return {'time' : x, 'total' : doses, 'bas' : doses * let[:, 0],
+                'haut' : doses * let[:, 1]}
 
 
 class DataHawk(AData):
@@ -262,7 +375,7 @@ class DataHawk(AData):
         file_.seek(0, 0)
         return num
 
-    def save_file(datafile, file_):
+    def parse_file(file_, flights):
         while 1:
             line = file_.readline()
             if chr(line[0]) == ',':
@@ -272,57 +385,92 @@ class DataHawk(AData):
         for col in df.columns:
             if hasattr(df[col], "str"):
                 df[col] = df[col].str.strip()
-        data = []
-        date = dt.datetime.strptime(df[1][0] + " " + df[2][0],
-                                    "%H:%M:%S %d%b%y")
-        flights = datafile.flight_file_fk.flight_set.all()
-        utc_off = pytz.timezone("Europe/Paris").localize(date).utcoffset()
-        coef = Coefficient.objects.filter(start__lte=date,
-                                          device_fk=datafile.device_fk).last()
-        for i in range(0, len(df.index) - 1):
-            params = {}
-            time = dt.datetime.strptime(df[1][i] + " " + df[2][i],
-                                              "%H:%M:%S %d%b%y")
-            params["time"] = (time - utc_off).replace(tzinfo=pytz.utc)
-            params["volt"] = unitConv(df[4][i].item(), df[5][i], "V")
-            params["current"] = unitConv(df[6][i], df[7][i], "µA")
-            params["temp"] = unitConv(df[8][i].item(), df[9][i], "C")
-            params["qfactor"] = df[29][i]
-            params["gamma_dose"] = unitConv(df[35][i], df[36][i], "µG") 
-            params["dose_equ"] = unitConv(df[37][i], df[38][i], "µS")
-            params["bas_LET"] = params["gamma_dose"] * float(coef.bas_LET)
-            params["haut_LET"] = (params["dose_equ"] - params["gamma_dose"]) \
-                * float(coef.haut_LET)
-            params["flight_fk"] = getFlightAt(flights, params["time"])
-            data.append(DataHawk(file_fk=datafile, **params))
-        DataHawk.objects.bulk_create(data)
+        dates = pandas.to_datetime(df[1] + " " + df[2],
+                                   format="%H:%M:%S %d%b%y")
+        # the last line of the log is not saved
+        df = df[:-1]
+        times = localToUtc(dates[:-1], dates[0].to_pydatetime())
+        return {
+            "time" : times.dt.to_pydatetime(),
+            "flight" : flights.at(times),
+            "volt" : unitConv(df[4], df[5], "V"),
+            "current" : unitConv(df[6], df[7], "µA"),
+            "temp" : unitConv(df[8], df[9], "C"),
+            "qfactor" : df[29].values,
+            "gamma_dose" : unitConv(df[35], df[36], "µG"),
+            "dose_equ" : unitConv(df[37], df[38], "µS"),
+        }
+
+    # LET columns use the coefficient of the device at the time of each
+    # measure, they are computed from the saved doses as in calibrate
+    def save_columns(datafile, columns):
+        times = columns["time"]
+        if Coefficient.at(datafile.device_fk_id, min(times)) is None:
+            raise ValueError("no coefficient for " + str(datafile.device_fk))
+        columns["bas_LET"] = columns["haut_LET"] = np.zeros(len(times))
+        AData.save_columns(datafile, columns)
+        DataHawk.apply_coefficients(DataHawk.objects.filter(file_fk=datafile),
+                                    datafile.device_fk_id, min(times),
+                                    max(times))
+
+    # sql expressions of the LET columns with coefficient coef, rounded as
+    # the decimal fields
+    def let_expressions(coef):
+        let = {
+            "bas_LET" : F("gamma_dose") * Value(float(coef.bas_LET)),
+            "haut_LET" : (F("dose_equ") - F("gamma_dose"))
+                * Value(float(coef.haut_LET)),
+        }
+        return {key : Func(expr, Value(7), function="ROUND",
+                           output_field=models.DecimalField())
+                for key, expr in let.items()}
+
+    # update the LET columns of data (queryset of DataHawk of device) measured
+    # between times first and last, with one query by coefficient
+    def apply_coefficients(data, device_id, first, last):
+        for coef, start, end in Coefficient.intervals(device_id, first, last):
+            rows = data.filter(time__gte=start)
+            if end is not None:
+                rows = rows.filter(time__lt=end)
+            rows.update(**DataHawk.let_expressions(coef))
+
+    def calibrate(device, start):
+        start = coefficientStart(start)
+        intervals = Coefficient.intervals(device.id, start, start)
+        if len(intervals) == 0:
+            return DataHawk.objects.none()
+        # data after the next coefficient is not changed
+        end = intervals[-1][2]
+        data = DataHawk.objects.filter(file_fk__device_fk=device,
+                                       time__gte=start)
+        if end is not None:
+            data = data.filter(time__lt=end)
+        last = data.aggregate(last=Max("time"))["last"]
+        if last is None:
+            return DataHawk.objects.none()
+        DataHawk.apply_coefficients(data, device.id, start, last)
+        return data
 
     def integrate_dose(data):
-        bLET = 0
-        hLET = 0
-        for d in data:
-            bLET += d.bas_LET
-            hLET += d.haut_LET
-        return IntegratedDose(dose=(bLET + hLET), bas_LET=bLET, haut_LET=hLET)
+        return sumDoses({'bas' : sum(d.bas_LET for d in data),
+                         'haut' : sum(d.haut_LET for d in data)})
+
+    def integrate_flights(data):
+        sums = data.exclude(flight_fk=None).order_by().values('flight_fk') \
+            .annotate(bas=Sum('bas_LET'), haut=Sum('haut_LET'))
+        return [sumDoses(s) for s in sums]
     
     def dose_rate(data, time):
-        prev_time = time
-        rate = {'time' : [], 'bas' : [], 'haut' : [], 'total' : []}
-        for d in data:
-            time_diff = (d.time - prev_time).total_seconds()
-            rate['time'].append('0000-01-01 ' + str(d.time - time))
-            if time_diff == 0:
-                bas = 0
-                haut = 0
-            else:
-                bas = float(d.bas_LET) / (time_diff / 3600)
-                haut = float(d.haut_LET) / (time_diff / 3600)
-            rate['bas'].append(bas)
-            rate['haut'].append(haut)
-            rate['total'].append(bas + haut)
-            prev_time = d.time
+        x, bas, haut = getColumns(data, ["time", "bas_LET", "haut_LET"], time)
+        # dose of each measure is integrated since the previous one
+        hours = np.diff(x, prepend=0) / 3600
+        rate = {'time' : x}
+        for key, dose in (('bas', bas), ('haut', haut)):
+            rate[key] = np.divide(dose, hours, out=np.zeros(len(x)),
+                                  where=(hours != 0))
+        rate['total'] = rate['bas'] + rate['haut']
         return rate
- 
+
 
 
 # Add device models before
@@ -366,6 +514,58 @@ class IntegratedDose(models.Model):
     bas_LET = models.DecimalField(max_digits=14, decimal_places=7, null=True)
     haut_LET = models.DecimalField(max_digits=14, decimal_places=7, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['flight_fk', 'datafile_fk']),
+        ]
+
+
+# dose rate of a datafile during a flight, cache of AData.dose_rate
+# deleted with its datafile and by recalibrate
+class DoseRate(models.Model):
+    datafile_fk = models.ForeignKey('DataFile', on_delete=models.CASCADE)
+    flight_fk = models.ForeignKey('Flight', on_delete=models.CASCADE)
+    # zlib compressed float64 arrays of seriesKeys
+    series = models.BinaryField()
+
+    seriesKeys = ('time', 'bas', 'haut', 'total')
+
+    # dose_rate of datafile during flight, computed and saved on first use
+    def get(datafile, flight):
+        cached = DoseRate.objects.filter(datafile_fk=datafile,
+                                         flight_fk=flight).first()
+        if cached is not None:
+            return cached.unpack()
+        data_dev = deviceDict[datafile.device_fk.dtype]
+        data = data_dev.objects.filter(file_fk=datafile, flight_fk=flight) \
+            .order_by('time')
+        rate = data_dev.dose_rate(data, flight.time_off)
+        if len(rate['time']) == 0:
+            return rate
+        try:
+            with transaction.atomic():
+                DoseRate.objects.create(datafile_fk=datafile,
+                                        flight_fk=flight,
+                                        series=DoseRate.pack(rate))
+        except DatabaseError:
+            # saved by a concurrent request or database locked by an upload,
+            # the rate is returned without being cached
+            pass
+        return rate
+
+    def pack(rate):
+        arrays = np.vstack([np.asarray(rate[key], dtype='<f8')
+                            for key in DoseRate.seriesKeys])
+        return zlib.compress(arrays.tobytes())
+
+    def unpack(self):
+        arrays = np.frombuffer(zlib.decompress(self.series), dtype='<f8')
+        arrays = arrays.reshape(len(DoseRate.seriesKeys), -1)
+        return dict(zip(DoseRate.seriesKeys, arrays))
+
+    class Meta:
+        unique_together = (('datafile_fk', 'flight_fk'),)
+
 
 class FlightFile(models.Model):
     filename = models.CharField(max_length=255)
@@ -374,6 +574,12 @@ class FlightFile(models.Model):
     matricule = models.CharField(max_length=32)
     model = models.CharField(max_length=32)
 
+    # FlightIndex of the flights of the file, built once per instance
+    def flight_index(self):
+        if not hasattr(self, '_flight_index'):
+            self._flight_index = FlightIndex(self.flight_set.order_by('id'))
+        return self._flight_index
+
     def __str__(self):
         return (self.filename)
 
@@ -386,7 +592,7 @@ class Flight(models.Model):
     time_dep = models.DateTimeField()
     time_arr = models.DateTimeField()
     time_out = models.DateTimeField()
-    time_off = models.DateTimeField()
+    time_off = models.DateTimeField(db_index=True)
     time_on = models.DateTimeField()
     time_in = models.DateTimeField()
 
@@ -402,12 +608,57 @@ class DeviceVersion(models.Model):
         return (deviceDict[self.dtype].metadata["name"] + "-" + self.version)
 
 
+# first utc datetime where a coefficient starting at date start applies
+def coefficientStart(start):
+    return dt.datetime.combine(start, dt.time(), tzinfo=pytz.utc)
+
+
+# memoised coefficients of each device {device id : (load time,
+# sorted start dates, coefficients)}, see Coefficient.timeline
+coefficientTimelines = {}
+# seconds before a timeline is loaded again, for coefficients added by
+# other processes
+coefficientTimelineTtl = 60
+
+
 class Coefficient(models.Model):
     device_fk = models.ForeignKey(Device, on_delete=models.CASCADE)
     start = models.DateField()
     bas_LET = models.DecimalField(max_digits=14, decimal_places=7)
     haut_LET = models.DecimalField(max_digits=14, decimal_places=7)
-    
+
+    # sorted start dates and coefficients of a device, the last added
+    # coefficient is after the others of the same start
+    def timeline(device_id):
+        cached = coefficientTimelines.get(device_id)
+        if cached is None or time.time() - cached[0] > coefficientTimelineTtl:
+            coefs = list(Coefficient.objects.filter(device_fk=device_id)
+                         .order_by('start', 'id'))
+            cached = (time.time(), [c.start for c in coefs], coefs)
+            coefficientTimelines[device_id] = cached
+        return cached[1:]
+
+    # forget the memoised timelines, to call when coefficients change
+    def clear_cache():
+        coefficientTimelines.clear()
+
+    # coefficient of a device at aware datetime date or None
+    def at(device_id, date):
+        starts, coefs = Coefficient.timeline(device_id)
+        idx = bisect.bisect_right(starts, date.astimezone(pytz.utc).date())
+        return coefs[idx - 1] if idx > 0 else None
+
+    # list of (coefficient, start, end or None) of the coefficients of a
+    # device applying between datetimes first and last
+    def intervals(device_id, first, last):
+        starts, coefs = Coefficient.timeline(device_id)
+        lo = bisect.bisect_right(starts, first.astimezone(pytz.utc).date())
+        hi = bisect.bisect_right(starts, last.astimezone(pytz.utc).date())
+        bounds = [coefficientStart(start) for start in starts] + [None]
+        return [(coefs[idx], bounds[idx], bounds[idx + 1])
+                for idx in range(max(lo - 1, 0), hi)
+                if bounds[idx] != bounds[idx + 1]]
+
     def __str__(self):
         return str(self.bas_LET) + ", " + str(self.haut_LET)
         
@@ -416,6 +667,57 @@ class Coefficient(models.Model):
  
 
 
+# upload processed in background by the ingest_worker command
+# flight_filename is empty when datafiles are added to flight_file_fk
+class UploadJob(models.Model):
+    # staging jobs are not claimed by the workers until their files are
+    # written
+    STATUS = (
+        ("staging", "staging"),
+        ("pending", "pending"),
+        ("running", "running"),
+        ("done", "done"),
+        ("error", "error"),
+    )
+    user_fk = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    flight_file_fk = models.ForeignKey('FlightFile', on_delete=models.SET_NULL,
+                                       null=True, blank=True)
+    flight_filename = models.CharField(max_length=255, blank=True)
+    year = models.CharField(max_length=32, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS,
+                              default="pending")
+    error = models.TextField(blank=True)
+    created = models.DateTimeField('date created', auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # new coefficient whose device data is recalibrated, None for uploads
+    coefficient_fk = models.ForeignKey('Coefficient', on_delete=models.CASCADE,
+                                       null=True, blank=True)
+
+    # directory of staged files
+    def directory(self):
+        return os.path.join(settings.UPLOAD_DIR, str(self.id))
+
+    def flight_path(self):
+        return os.path.join(self.directory(), "flightfile")
+
+    def __str__(self):
+        return (str(self.id) + " " + self.status)
+
+
+class UploadJobFile(models.Model):
+    job_fk = models.ForeignKey(UploadJob, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    dtype = models.CharField(max_length=255, choices=tuple(deviceChoises))
+    version_fk = models.ForeignKey('DeviceVersion', null=True, blank=True,
+                                   on_delete=models.SET_NULL)
+
+    def path(self):
+        return os.path.join(self.job_fk.directory(), str(self.id))
+
+    def __str__(self):
+        return (self.filename)
+
+
 class CustomPermission(models.Model):
 
     class Meta:
@@ -1,3 +1,100 @@
+import datetime as dt
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
 from django.test import TestCase
 
-# Create your tests here.
+from .models import *
+from .upload import work
+
+
+flightCsv = """x
+x
+x
+Matricule F-GSPA;Modele B777
+x
+Date TdL;Dep.;Dep.;Arr.;Arr.;OUT;OFF;ON;IN;N volCause IRG
+12/03;CDG PARIS;08:00:00;JFK NEW YORK;16:10:00;A 08:00;A 08:20;A 16:00;A 16:10;AF 009
+12/03;JFK NEW YORK;18:00:00;CDG PARIS;23:50:00;A 18:00;A 18:15;A 23:40;A 23:50;AF 008
+13/03;CDG PARIS;10:00:00;NCE NICE;11:40:00;A 10:00;A 10:10;A 11:30;A 11:40;AF 010
+"""
+
+
+# hawk log measured every 5 minutes from 12/03/2018 09:00 to 13/03/2018
+# 13:00 (local time)
+def hawkLog():
+    lines = ["hawk log", "x", "x", "Serial: ABCDHAWK0042WXYZ", "x",
+             ",start", "header"]
+    date = dt.datetime(2018, 3, 12, 9)
+    for i in range(336):
+        lines.append(
+            "r, %s,x,%d, mV,2.383, nA,33, C," % (
+                date.strftime("%H:%M:%S, %d%b%y"), 300 + i % 50)
+            + "0," * 19 + "1.498,0,0,0,0,0,"
+            + "%.4f, nG,%.4f, uS" % (0.1 + (i % 7) / 10, 1 + (i % 11) / 10))
+        date += dt.timedelta(minutes=5)
+    return ("\n".join(lines) + "\n").encode('ascii')
+
+
+class RecalibrationTest(TestCase):
+
+    def setUp(self):
+        Coefficient.clear_cache()
+        self.user = User.objects.create_superuser('admin', 'admin@dbaf.fr',
+                                                  'password')
+        self.client.force_login(self.user)
+        # staged files of the jobs
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        upload_settings = self.settings(UPLOAD_DIR=upload_dir)
+        upload_settings.enable()
+        self.addCleanup(upload_settings.disable)
+        self.device = Device.objects.create(dtype="DataHawk",
+                                            serial_num="HAWK0042")
+        Coefficient.objects.create(device_fk=self.device,
+                                   start=dt.date(2018, 1, 1),
+                                   bas_LET="1.5", haut_LET="0.7")
+
+    # upload the flight file and the hawk log as the upload page and
+    # process the job as the ingest_worker
+    def ingest(self):
+        response = self.client.post('/upload/?year=2018', {
+            'is_flightfile' : 'on',
+            'flightfile' : ContentFile(flightCsv.encode('ascii'),
+                                       name="flights.csv"),
+            'datafiles' : ContentFile(hawkLog(), name="hawk.txt"),
+            'device0' : 'DataHawk'})
+        self.assertEqual(response.status_code, 302)
+        work(once=True)
+        job = UploadJob.objects.order_by('-id')[0]
+        self.assertEqual((job.status, job.error), ("done", ""))
+        return DataFile.objects.get(flight_file_fk=job.flight_file_fk)
+
+    def stored(self, datafile):
+        rows = list(DataHawk.objects.filter(file_fk=datafile).order_by('time')
+                    .values_list('time', 'flight_fk__num', 'bas_LET',
+                                 'haut_LET'))
+        idoses = list(IntegratedDose.objects.filter(datafile_fk=datafile)
+                      .order_by('flight_fk__num')
+                      .values_list('flight_fk__num', 'dose', 'bas_LET',
+                                   'haut_LET'))
+        return rows, idoses
+
+    def test_add_coeff_same_as_fresh_ingest(self):
+        datafile = self.ingest()
+        before = self.stored(datafile)
+        response = self.client.post('/add/coeff/', {
+            'device' : self.device.id, 'bLET' : '2.25', 'hLET' : '0.9',
+            'date' : '2018-03-13'})
+        self.assertEqual(response.status_code, 302)
+        work(once=True)
+        job = UploadJob.objects.order_by('-id')[0]
+        self.assertEqual((job.status, job.error), ("done", ""))
+        recalibrated = self.stored(datafile)
+        # only the flight of 13/03 is measured under the new coefficient
+        self.assertNotEqual(before[1][2], recalibrated[1][2])
+        self.assertEqual(before[1][:2], recalibrated[1][:2])
+        FlightFile.objects.all().delete()
+        self.assertEqual(self.stored(self.ingest()), recalibrated)
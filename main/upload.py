@@ -0,0 +1,404 @@
+import datetime as dt
+import pytz
+import os
+import re
+import time
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction, OperationalError
+from django.utils import timezone
+import dateparser
+import pandas
+
+from .models import *
+from .utils import *
+
+
+def add_date_time(date, time_str, tformat):
+    time = dt.datetime.strptime(time_str, tformat)
+    return date_inc(date, time).replace(tzinfo=pytz.utc)
+
+
+# parse flightfile without database access return the unsaved FlightFile
+# and list of its Flight or None, None on error
+def read_flight_file(file_, year, user):
+    try:
+        return parse_flight_file(file_, year, user)
+    except Exception as e:
+        print("Error", type(e).__name__, e)
+        return None, None
+
+
+# save in db a FlightFile and its flights returned by read_flight_file
+def save_flight_file(flight_file, flights):
+    flight_file.save()
+    for flight in flights:
+        flight.file_fk = flight_file
+    bulkCreate(Flight, flights)
+    return flight_file
+
+
+# parse flightflie without database access, can throw
+def parse_flight_file(file_, year, user):
+    # Parse file header (matricule, model)
+    df_h = pandas.read_csv(
+        file_, skipinitialspace=True, sep=';',
+        skiprows=3, nrows=1, header=None)
+    flight_file = FlightFile(
+        filename=getattr(file_, "name", "input"), 
+        matricule=df_h[0][0].split(' ')[-1],
+        model=df_h[1][0].split(' ')[-1],
+        user_fk=user)
+    # Parse file body
+    file_.seek(0, 0)
+    df = pandas.read_csv(file_, skipinitialspace=True, sep=';', skiprows=5,
+                        dtype={"N volCause IRG" : object})
+    flights = []
+    old_date = None
+    for idx in range(0, len(df.index)):
+        if (isnotnan(df["OFF"][idx]) and isnotnan(df["ON"])
+                and df["ON"][idx][0] == 'A'):
+            dstr = df["Date TdL"][idx] + " " + df["Dep..1"][idx] \
+                + " " + year
+            date = dateparser.parse(
+                dstr, settings={"PREFER_DATES_FROM" : "past",
+                                "DATE_ORDER" : "DMY"})
+            if (year != "" and old_date != None and old_date > date):
+                date.replace(year=date.year + 1)
+            date_arr = add_date_time(date, df["Arr..1"][idx], "%H:%M:%S")
+            date_out = add_date_time(date, df["OUT"][idx][-5::], "%H:%M")
+            date_off = add_date_time(date, df["OFF"][idx][-5::], "%H:%M")
+            date_on = add_date_time(date, df["ON"][idx][-5::], "%H:%M")
+            date_in = add_date_time(date, df["IN"][idx][-5::], "%H:%M")
+            flights.append(Flight(
+                file_fk=flight_file,
+                num=" ".join(df["N volCause IRG"][idx].split()),
+                airport_from=" ".join(df["Dep."][idx].split()),
+                airport_to=" ".join(df["Arr."][idx].split()),
+                time_dep=date.replace(tzinfo = pytz.utc),
+                time_arr=date_arr, time_out=date_out, time_off=date_off,
+                time_on=date_on, time_in=date_in
+                ))
+    return flight_file, flights
+
+
+# find the device of a datafile and save the datafile without its data
+# return datafile or None on error
+def add_data_file(file_, dtype, flight_file, version):
+        try:
+            serial_num = deviceDict[dtype].get_serial_num(file_)
+            device = Device.objects.filter(dtype=dtype, version_fk=version,
+                                           serial_num=serial_num).get()
+            datafile = DataFile(filename=file_.name, flight_file_fk=flight_file,
+                                device_fk=device)
+            datafile.save()
+            return datafile, None
+        except OperationalError:
+            raise
+        except Exception as e:
+            print("Error", type(e).__name__, e)
+            dev = str(Device(dtype=dtype, version_fk=version, serial_num=serial_num))
+            return None, "device " + dev + " does not exist."
+
+
+# save the data of datafile, parse = function returning the parsed columns
+# return datafile or None on error, the datafile row is left to the caller
+def save_data_columns(datafile, parse):
+        try:
+            with transaction.atomic():
+                deviceDict[datafile.device_fk.dtype].save_columns(datafile,
+                                                                  parse())
+            return datafile, None
+        except OperationalError:
+            raise
+        except Exception as e:
+            print ("Error", type(e).__name__, e)
+            return None, "wrong format."
+
+
+# parse a file on disk, run in the processes of parse_pool
+def parse_path(dtype, path, filename, flights):
+    with open(path, 'rb') as f:
+        return deviceDict[dtype].parse_file(File(f, filename), flights)
+
+
+# parse_path returning (seconds taken, columns)
+def time_parse_path(dtype, path, filename, flights):
+    start = time.time()
+    columns = parse_path(dtype, path, filename, flights)
+    return time.time() - start, columns
+
+
+# pool of processes to parse nb files with at most workers processes
+# (default settings.UPLOAD_PARSE_WORKERS), parsers do not use the database
+# so the forked processes share the django setup of the parent
+def parse_pool(nb, workers=None):
+    workers = workers or settings.UPLOAD_PARSE_WORKERS
+    return ProcessPoolExecutor(max_workers=max(1, min(nb, workers)),
+                               mp_context=multiprocessing.get_context('fork'))
+
+
+# Compute the integrated dose for all fligths
+def idose_flights(datafile, flights):
+    data_device = deviceDict[datafile.device_fk.dtype]
+    flight_ids = set(flight.id for flight in flights)
+    idoses = data_device.integrate_flights(
+        data_device.objects.filter(file_fk=datafile))
+    for idose in idoses:
+        idose.datafile_fk = datafile
+    return [idose for idose in idoses if idose.flight_fk_id in flight_ids]
+
+
+# update the IntegratedDose of datafile for the flights of ids flight_ids
+# from its data and forget their cached dose rates
+def reintegrate(datafile, flight_ids):
+    DoseRate.objects.filter(datafile_fk=datafile,
+                            flight_fk__in=flight_ids).delete()
+    data_device = deviceDict[datafile.device_fk.dtype]
+    idoses = {idose.flight_fk_id : idose
+              for idose in data_device.integrate_flights(
+                  data_device.objects.filter(file_fk=datafile,
+                                             flight_fk__in=flight_ids))}
+    for idose in idoses.values():
+        idose.datafile_fk = datafile
+    updated = []
+    for idose in IntegratedDose.objects.filter(datafile_fk=datafile,
+                                               flight_fk__in=flight_ids):
+        new = idoses.pop(idose.flight_fk_id, None)
+        if new is not None:
+            idose.dose = new.dose
+            idose.bas_LET = new.bas_LET
+            idose.haut_LET = new.haut_LET
+            updated.append(idose)
+    IntegratedDose.objects.bulk_update(updated, ['dose', 'bas_LET', 'haut_LET'],
+                                       batch_size=batchSize)
+    bulkCreate(IntegratedDose, idoses.values())
+
+
+# recompute the data of device depending on its coefficients from date start
+# and the IntegratedDose of the flights with updated data, return updated
+# datafiles
+def recalibrate(device, start):
+    Coefficient.clear_cache()
+    with transaction.atomic():
+        rows = deviceDict[device.dtype].calibrate(device, start)
+        flights = {}
+        for file_id, flight_id in rows.exclude(flight_fk=None).order_by() \
+                .values_list('file_fk', 'flight_fk').distinct():
+            flights.setdefault(file_id, []).append(flight_id)
+        datafiles = list(DataFile.objects.filter(
+            id__in=rows.values('file_fk')).select_related('device_fk'))
+        for datafile in datafiles:
+            reintegrate(datafile, flights.get(datafile.id, []))
+    return datafiles
+
+
+# device type of a datafile name, the first device whose metadata fileExt
+# matches as in the upload page, None if no device matches
+def guess_dtype(filename):
+    for device in deviceList:
+        if re.search(device.metadata["fileExt"] + "$", filename):
+            return device.__name__
+    return None
+
+
+# read the flightfile at flight_path and submit the parse of its datafiles
+# = list of (path, dtype, version id or None) to pool, nothing is saved
+# return unsaved flightfile or None on error, its flights and list of
+# (path, dtype, version id, future of time_parse_path)
+def submit_paths(pool, user, flight_path, year, datafiles):
+    with open(flight_path, 'rb') as f:
+        flightfile, flights = read_flight_file(
+            File(f, os.path.basename(flight_path)), year, user)
+    if (flightfile == None):
+        return None, None, []
+    index = FlightIndex(flights)
+    return flightfile, flights, [
+        (path, dtype, version, pool.submit(time_parse_path, dtype, path,
+                                           os.path.basename(path), index))
+        for path, dtype, version in datafiles]
+
+
+# save a flightfile with its flights and datafiles parsed by submit_paths
+# in one transaction, return list of (path, number of saved rows, seconds)
+# and None or error message, nothing is saved on error
+def save_paths(flightfile, flights, parsed):
+    report = []
+    with transaction.atomic():
+        save_flight_file(flightfile, flights)
+        err = save_path_files(flightfile, parsed, report)
+        if (err != None):
+            transaction.set_rollback(True)
+    return report, err
+
+
+def save_path_files(flightfile, parsed, report):
+    flights = flightfile.flight_index().flights
+    idoses = []
+    for path, dtype, version, future in parsed:
+        start = time.time()
+        with open(path, 'rb') as f:
+            datafile, err = add_data_file(File(f, os.path.basename(path)),
+                                          dtype, flightfile, version)
+        if (err != None):
+            return "File : " + path + " " + err
+        try:
+            seconds, columns = future.result()
+        except Exception as e:
+            print("Error", type(e).__name__, e)
+            return "File : " + path + " wrong format."
+        datafile, err = save_data_columns(datafile, lambda: columns)
+        if (err != None):
+            return "File : " + path + " " + err
+        idoses += idose_flights(datafile, flights)
+        report.append((path, len(columns["time"]),
+                       seconds + time.time() - start))
+    bulkCreate(IntegratedDose, idoses)
+    return None
+
+
+# create an UploadJob and stage its files on disk
+# datafiles = list of (uploaded file, dtype, version id or None)
+# flightfile = uploaded flight file or None to add datafiles to flight_file
+def stage_job(user, datafiles, flightfile=None, year="", flight_file=None):
+    job = UploadJob.objects.create(
+        user_fk=user, flight_file_fk=flight_file, year=year, status="staging",
+        flight_filename=(flightfile.name if flightfile is not None else ""))
+    try:
+        os.makedirs(job.directory())
+        if flightfile is not None:
+            write_chunks(flightfile, job.flight_path())
+        for file_, dtype, version in datafiles:
+            jfile = UploadJobFile.objects.create(
+                job_fk=job, filename=file_.name, dtype=dtype,
+                version_fk_id=version)
+            write_chunks(file_, jfile.path())
+    except Exception:
+        job.status = "error"
+        job.error = "upload failed."
+        job.finished = timezone.now()
+        job.save()
+        shutil.rmtree(job.directory(), ignore_errors=True)
+        raise
+    # the job can be claimed by a worker once all its files are written
+    job.status = "pending"
+    job.save(update_fields=['status'])
+    return job
+
+
+def write_chunks(file_, path):
+    with open(path, 'wb') as out:
+        for chunk in file_.chunks():
+            out.write(chunk)
+
+
+# queue the recalibration of the data of the device of a new coefficient
+def stage_recalibration(user, coef):
+    return UploadJob.objects.create(user_fk=user, coefficient_fk=coef)
+
+
+# parse and save the staged files of a job or recalibrate, set job status
+# to done or error
+def run_job(job):
+    try:
+        if job.coefficient_fk is not None:
+            err = recalibrate_job(job)
+        else:
+            err = ingest_job(job)
+    except Exception as e:
+        print("Error", type(e).__name__, e)
+        err = "unexpected error."
+    job.status = "error" if err is not None else "done"
+    job.error = err or ""
+    job.finished = timezone.now()
+    job.save()
+    shutil.rmtree(job.directory(), ignore_errors=True)
+
+
+# stored data was calibrated with a previous coefficient, return None
+def recalibrate_job(job):
+    coef = job.coefficient_fk
+    recalibrate(coef.device_fk, coef.start)
+    return None
+
+
+# return None or error message, nothing is saved on error
+def ingest_job(job):
+    # coefficients may have been added by the web server
+    Coefficient.clear_cache()
+    flightfile, flights = job.flight_file_fk, None
+    if job.flight_filename != "":
+        with open(job.flight_path(), 'rb') as f:
+            flightfile, flights = read_flight_file(
+                File(f, job.flight_filename), job.year, job.user_fk)
+        if (flightfile == None):
+            return "Flight file wrong format"
+        index = FlightIndex(flights)
+    else:
+        index = flightfile.flight_index()
+    # files are parsed in parallel with no transaction open, the new flight
+    # file is saved with them
+    jfiles = list(job.uploadjobfile_set.order_by('id'))
+    with parse_pool(len(jfiles)) as pool:
+        parsed = [pool.submit(parse_path, jfile.dtype, jfile.path(),
+                              jfile.filename, index)
+                  for jfile in jfiles]
+    with transaction.atomic():
+        if flights is not None:
+            save_flight_file(flightfile, flights)
+        err = save_job_files(flightfile, zip(jfiles, parsed))
+        if (err != None):
+            transaction.set_rollback(True)
+            return err
+    job.flight_file_fk = flightfile
+    return None
+
+
+# save the parsed files of a job = list of (UploadJobFile, parse future)
+# in the order of the job, return None or error message
+def save_job_files(flightfile, parsed):
+    staged = []
+    for jfile, future in parsed:
+        with open(jfile.path(), 'rb') as f:
+            datafile, err = add_data_file(File(f, jfile.filename),
+                                          jfile.dtype, flightfile,
+                                          jfile.version_fk)
+        if (err != None):
+            return "File : " + jfile.filename + " " + err
+        staged.append((jfile, datafile, future))
+    idoses = []
+    for jfile, datafile, future in staged:
+        datafile, err = save_data_columns(datafile, future.result)
+        if (err != None):
+            return "File : " + jfile.filename + " " + err
+        idoses += idose_flights(datafile, flightfile.flight_index().flights)
+    bulkCreate(IntegratedDose, idoses)
+    return None
+
+
+# take the oldest pending job, return None if there is no pending job
+def claim_job():
+    for job in UploadJob.objects.filter(status="pending").order_by('id')[:10]:
+        # only one worker can switch the job from pending to running
+        if UploadJob.objects.filter(pk=job.pk, status="pending") \
+                .update(status="running"):
+            job.status = "running"
+            return job
+    return None
+
+
+# process pending jobs, wait sleep seconds when there is no pending job
+# or return if once is True
+def work(sleep=2, once=False):
+    while True:
+        job = claim_job()
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(sleep)
@@ -7,6 +7,7 @@ urlpatterns = [
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('upload/', views.upload, name='upload'),
+    path('upload/job/<int:id_job>/', views.job_status, name='job_status'),
     path('add/device/', views.add_device, name='add_device'),
     path('add/version/', views.add_version, name='add_version'),
     path('add/coeff/', views.add_coeff, name='add_coeff'),
@@ -1,35 +1,47 @@
 import time
 import datetime
+import base64
 import pytz
 
 import numpy
+import pandas
 
 
+# power of ten of SI prefixes
+powDict = {
+    "Y" : 24,
+    "Z" : 21,
+    "E" : 18,
+    "P" : 15,
+    "T" : 12,
+    "G" : 9,
+    "M" : 6,
+    "k" : 3,
+    "h" : 2,
+    "da" : 1,
+    "" : 0,
+    "d" : -1,
+    "c" : -2,
+    "m" : -3,
+    "µ" : -6, "u" : -6,
+    "n" : -9,
+    "p" : -12,
+    "f" : -15,
+    "a" : -18,
+    "z" : -21,
+    "y" : -24,
+}
+
+
+# convert nb from unit u1 to unit u2, ex : unitConv(3, "mV", "V") = 0.003
+# nb and u1 can also be arrays (numpy or pandas) of values and units
 def unitConv(nb, u1, u2):
-    powDict = {
-        "Y" : 24,
-        "Z" : 21,
-        "E" : 18,
-        "P" : 15,
-        "T" : 12,
-        "G" : 9,
-        "M" : 6,
-        "k" : 3,
-        "h" : 2,
-        "da" : 1,
-        "" : 0,
-        "d" : -1,
-        "c" : -2,
-        "m" : -3,
-        "µ" : -6, "u" : -6,
-        "n" : -9,
-        "p" : -12,
-        "f" : -15,
-        "a" : -18,
-        "z" : -21,
-        "y" : -24,
-    }
-    return nb * 10**(powDict[u1[:-1]] - powDict[u2[:-1]])
+    if isinstance(u1, str):
+        return nb * 10**(powDict[u1[:-1]] - powDict[u2[:-1]])
+    pows = pandas.Series(u1).str[:-1].map(powDict)
+    if pows.isnull().any():
+        raise KeyError(pandas.Series(u1)[pows.isnull()].iloc[0])
+    return numpy.asarray(nb) * 10.0**(pows.values - powDict[u2[:-1]])
 
 
 # function decorator
@@ -44,11 +56,21 @@ def time_func(func):
     return wrapper
 
 
+epoch = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 # convert date form timezone tz1 to tz2
 def convertTimezone(date, tz1, tz2):
     return pytz.timezone(tz1).localize(date).astimezone(pytz.timezone(tz2))
 
 
+# convert a pandas serie of naive dates in timezone tz to aware utc dates
+# the utc offset of date_ref is used for the whole serie
+def localToUtc(dates, date_ref, tz="Europe/Paris"):
+    utc_off = pytz.timezone(tz).localize(date_ref).utcoffset()
+    return (dates - utc_off).dt.tz_localize(pytz.utc)
+
+
 def isnotnan(a):
     if isinstance(a, float) and numpy.isnan(a):
         return (False)
@@ -63,3 +85,70 @@ def date_inc(date, time):
     return (ret)
 
 
+
+
+# convert a list or array of aware dates to a numpy array of naive utc
+# datetime64[ns]
+def toDatetime64(dates):
+    dates = pandas.DatetimeIndex(pandas.to_datetime(dates, utc=True))
+    return dates.tz_convert(None).values.astype('datetime64[ns]')
+
+
+# return the numpy array of seconds between each date of dates and t0
+def secondsSince(dates, t0):
+    return (toDatetime64(dates) - toDatetime64([t0])[0]) \
+        / numpy.timedelta64(1, 's')
+
+
+# format an array of seconds as str(datetime.timedelta) does ('H:MM:SS')
+def formatDurations(seconds):
+    us = numpy.rint(numpy.asarray(seconds) * 1e6).astype(numpy.int64)
+    s, us = numpy.divmod(us, 1000000)
+    h, s = numpy.divmod(s, 3600)
+    m, s = numpy.divmod(s, 60)
+    return ["%d:%02d:%02d" % t[:3] if t[3] == 0 else "%d:%02d:%02d.%06d" % t
+            for t in zip(h.tolist(), m.tolist(), s.tolist(), us.tolist())]
+
+
+# indices of the points kept to plot series ys (arrays of the same length)
+# on sorted abscissa x with about max_points points : the first and last
+# points, and the min and max of each serie in equal width buckets of x
+# evenly spaced points when max_points is too small for one bucket
+def downsampleIndices(x, ys, max_points):
+    if len(x) <= max_points:
+        return numpy.arange(len(x))
+    nb = (max_points - 2) // (2 * len(ys))
+    if nb < 1:
+        return numpy.unique(numpy.linspace(0, len(x) - 1, max(max_points, 0))
+                            .round().astype(int))
+    edges = numpy.linspace(x[0], x[-1], nb + 1)
+    bucket = numpy.searchsorted(edges, x, side='right').clip(1, nb) - 1
+    keep = [numpy.array([0, len(x) - 1])]
+    for y in ys:
+        # sorted by bucket then value, min and max are the bucket bounds
+        order = numpy.lexsort((y, bucket))
+        first = numpy.flatnonzero(numpy.diff(bucket[order], prepend=-1))
+        last = numpy.append(first[1:] - 1, len(x) - 1)
+        keep += [order[first], order[last]]
+    return numpy.unique(numpy.concatenate(keep))
+
+
+# base64 string of numbers packed as little-endian float32, decoded in
+# javascript as a Float32Array
+def b64Float32(values):
+    values = numpy.asarray(values, dtype='<f4')
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+# box plot statistics of an array of values, nan values are ignored
+# return None if there is no value
+def boxStats(values):
+    values = numpy.asarray(values, dtype=float)
+    values = values[~numpy.isnan(values)]
+    if len(values) == 0:
+        return None
+    q1, median, q3 = numpy.percentile(values, [25, 50, 75]).tolist()
+    return {"count" : len(values), "mean" : values.mean().item(),
+            "sd" : values.std().item(), "min" : values.min().item(),
+            "q1" : q1, "median" : median, "q3" : q3,
+            "max" : values.max().item()}
@@ -1,19 +1,25 @@
 import datetime as dt
-import pytz
-import io
+import csv
+import itertools
+import tempfile
 
-from django.contrib.auth.decorators import permission_required
+from django.contrib.auth.decorators import permission_required, login_required
 from django.contrib.auth import authenticate, login, logout
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db.models import Count, Min, Sum, Avg, F, Value, Q, Case, When
+from django.urls import reverse
+from django.core.files.base import ContentFile
+from django.core.paginator import Paginator
+from django.db.models import Count, Min, Max, Sum, Avg, F, Value, Q, Case, When
 from django.db.models.functions import Concat
-from django.http import HttpResponse, JsonResponse
-import dateparser
-import pandas
+from django.views.decorators.gzip import gzip_page
+from django.http import (JsonResponse, StreamingHttpResponse, FileResponse,
+                         HttpResponseBadRequest, Http404)
+import openpyxl
 import numpy
 
 from .models import *
 from .utils import *
+from .upload import *
 
 
 def home(request):
@@ -41,105 +47,6 @@ def logout_view(request):
     return (render(request, "logout.html", {}))
 
 
-def add_date_time(date, time_str, tformat):
-    time = dt.datetime.strptime(time_str, tformat)
-    return date_inc(date, time).replace(tzinfo=pytz.utc)
-
-
-# parse and save flightflie in db return flightfile or None on error
-def save_flight_file(file_, year, user):
-    try:
-        # Parse file header (matricule, model)
-        df_h = pandas.read_csv(
-            file_, skipinitialspace=True, sep=';',
-            skiprows=3, nrows=1, header=None)
-        flight_file = FlightFile(
-            filename=getattr(file_, "name", "input"), 
-            matricule=df_h[0][0].split(' ')[-1],
-            model=df_h[1][0].split(' ')[-1],
-            user_fk=user)
-        flight_file.save()
-    except Exception as e:
-        print("Error", type(e).__name__, e)
-        return None
-    try:
-        # Parse file body
-        file_.seek(0, 0)
-        df = pandas.read_csv(file_, skipinitialspace=True, sep=';', skiprows=5,
-                            dtype={"N volCause IRG" : object})
-        flights = []
-        old_date = None
-        for idx in range(0, len(df.index)):
-            if (isnotnan(df["OFF"][idx]) and isnotnan(df["ON"])
-                    and df["ON"][idx][0] == 'A'):
-                dstr = df["Date TdL"][idx] + " " + df["Dep..1"][idx] \
-                    + " " + year
-                date = dateparser.parse(
-                    dstr, settings={"PREFER_DATES_FROM" : "past",
-                                    "DATE_ORDER" : "DMY"})
-                if (year != "" and old_date != None and old_date > date):
-                    date.replace(year=date.year + 1)
-                date_arr = add_date_time(date, df["Arr..1"][idx], "%H:%M:%S")
-                date_out = add_date_time(date, df["OUT"][idx][-5::], "%H:%M")
-                date_off = add_date_time(date, df["OFF"][idx][-5::], "%H:%M")
-                date_on = add_date_time(date, df["ON"][idx][-5::], "%H:%M")
-                date_in = add_date_time(date, df["IN"][idx][-5::], "%H:%M")
-                flights.append(Flight(
-                    file_fk=flight_file,
-                    num=" ".join(df["N volCause IRG"][idx].split()),
-                    airport_from=" ".join(df["Dep."][idx].split()),
-                    airport_to=" ".join(df["Arr."][idx].split()),
-                    time_dep=date.replace(tzinfo = pytz.utc),
-                    time_arr=date_arr, time_out=date_out, time_off=date_off,
-                    time_on=date_on, time_in=date_in
-                    ))
-        Flight.objects.bulk_create(flights)
-        return flight_file
-    except Exception as e:
-        print("Error", type(e).__name__, e)
-        flight_file.delete()
-        return None
-
-
-# parse and save dataflie in db return datafile or None on error
-def save_data_file(file_, dtype, flight_file, version):
-        try:
-            serial_num = deviceDict[dtype].get_serial_num(file_)
-            device = Device.objects.filter(dtype=dtype, version_fk=version,
-                                           serial_num=serial_num).get()
-            datafile = DataFile(filename=file_.name, flight_file_fk=flight_file,
-                                device_fk=device)
-            datafile.save()
-        except Exception as e:
-            print("Error", type(e).__name__, e)
-            dev = str(Device(dtype=dtype, version_fk=version, serial_num=serial_num))
-            return None, "device " + dev + " does not exist."
-        try:
-            deviceDict[dtype].save_file(datafile, file_)
-            return datafile, None
-        except Exception as e:
-            print ("Error", type(e).__name__, e)
-            datafile.delete()
-            return None, "wrong format."
-
-
-# Compute the integrated dose for all fligths
-def idose_flights(datafile, flights):
-    data_device = deviceDict[datafile.device_fk.dtype]
-    idoses = []
-    for flight in flights:
-        data = data_device.objects.filter(
-            
-            flight_fk=flight, file_fk=datafile).all()
-        if len(data) != 0:
-            idose = data_device.integrate_dose(data)
-            if idose is not None:
-                idose.datafile_fk = datafile
-                idose.flight_fk = flight
-                idoses.append(idose)
-    return idoses
-
-
 # Get dict : { dtype : [list of version] }
 def get_devices_versions():
     deviceVers = {}
@@ -148,37 +55,54 @@ def get_devices_versions():
     return deviceVers
 
 
-# POST : save flightfile and datafiles
-# GET : display form
+# UploadJob given by the job parameter of a request or None
+def get_job(request):
+    if request.GET.get('job', '') == '':
+        return None
+    return UploadJob.objects.filter(pk=request.GET['job']).first()
+
+
+# POST : stage flightfile and datafiles for the ingest_worker
+# GET : display form and status of the job parameter
 @permission_required('main.upload', 'login')
 def upload(request):
     ctxt = {"deviceChoises" : deviceChoises, "deviceList" : deviceList, 
             "deviceVersions" : get_devices_versions()}
     if (request.method == "POST"):
         if (request.POST.get('is_flightfile', False) == False):
-            ffile = io.StringIO(request.POST['gen_file'])
+            ffile = ContentFile(request.POST['gen_file'].encode(),
+                                name="input")
         else:
             ffile = request.FILES.getlist('flightfile')[0]
-        flightfile = save_flight_file(ffile, request.GET.get("year", ""), request.user)
-        if (flightfile == None):
-            errors = ["Flight file wrong format"]
-            return (render(request, "upload.html", dict(errors=errors, **ctxt)))
-        else:
-            idoses = []
-            for idx, file_ in enumerate(request.FILES.getlist('datafiles')):
-                device = request.POST['device' + str(idx)]
-                version = request.POST.get('version' + str(idx), None)
-                datafile, err = save_data_file(file_, device, flightfile, version)
-                if (err != None):
-                    flightfile.delete()
-                    errors = ["File : " + file_.name + " " + err]
-                    return (render(request, "upload.html",
-                                   dict(errors=errors, **ctxt)))
-                idoses += idose_flights(datafile, flightfile.flight_set.all())
-            IntegratedDose.objects.bulk_create(idoses)
-            return (redirect('view_flights', flightfile.id))
+        datafiles = []
+        for idx, file_ in enumerate(request.FILES.getlist('datafiles')):
+            device = request.POST['device' + str(idx)]
+            version = request.POST.get('version' + str(idx), None) or None
+            datafiles.append((file_, device, version))
+        job = stage_job(request.user, datafiles, flightfile=ffile,
+                        year=request.GET.get("year", ""))
+        return (redirect(reverse('upload') + '?job=' + str(job.id)))
     else:
-        return (render(request, "upload.html", ctxt))
+        return (render(request, "upload.html", dict(job=get_job(request),
+                                                    **ctxt)))
+
+
+# status of an UploadJob, recalibration jobs are polled by the users
+# adding coefficients
+@login_required(login_url='login')
+def job_status(request, id_job):
+    job = get_object_or_404(UploadJob, pk=id_job)
+    perm = 'main.add' if job.coefficient_fk_id is not None else 'main.upload'
+    if (not request.user.has_perm(perm)
+            or (job.user_fk != request.user and not request.user.is_superuser)):
+        return (redirect('login'))
+    url = None
+    if job.coefficient_fk_id is not None:
+        url = reverse('view_devices')
+    elif job.flight_file_fk is not None:
+        url = reverse('view_flights', args=[job.flight_file_fk.id])
+    return JsonResponse({"status" : job.status, "error" : job.error,
+                         "url" : url})
 
 
 @permission_required('main.upload', 'login')
@@ -253,10 +177,13 @@ def add_coeff(request):
         device = request.POST['device']
         coeff_b = request.POST['bLET']
         coeff_h = request.POST['hLET']
-        date = dt.datetime.strptime(request.POST['date'], "%Y-%m-%d")
-        Coefficient.objects.create(device_fk_id=device, start=date,
-                                   bas_LET=coeff_b, haut_LET=coeff_h)
-        return (redirect('view_devices'))
+        date = dt.datetime.strptime(request.POST['date'], "%Y-%m-%d").date()
+        coef = Coefficient.objects.create(device_fk_id=device, start=date,
+                                          bas_LET=coeff_b, haut_LET=coeff_h)
+        Coefficient.clear_cache()
+        # stored data is recalibrated by the ingest_worker
+        job = stage_recalibration(request.user, coef)
+        return (redirect(reverse('view_devices') + '?job=' + str(job.id)))
     return (render(request, "add_coeff.html", ctxt))
 
 def search_querry(elem, str_search):
@@ -268,71 +195,220 @@ def search_querry(elem, str_search):
         querry |= subquerry
     return querry
 
+# GET parameters : file, flight and optionaly start and end (seconds since
+# takeoff) to select a time range, max_points to downsample the series,
+# encoding=compact for series as b64Float32 with time in seconds
 @permission_required('main.view', 'login')
+@gzip_page
 def rate_(request):
-    file_fk = request.GET['file']
-    flight_fk = request.GET['flight']
-    device = DataFile.objects.get(pk=file_fk).device_fk
-    data_dev = deviceDict[device.dtype]
-    data = data_dev.objects.filter(file_fk=file_fk, flight_fk=flight_fk).all()
-    flight = data[0].flight_fk
-    rate = data_dev.dose_rate(data, flight.time_off)
+    datafile = get_object_or_404(DataFile.objects.select_related(
+        'device_fk__version_fk'), pk=request.GET['file'])
+    flight = get_object_or_404(Flight, pk=request.GET['flight'])
+    if (flight.file_fk_id != datafile.flight_file_fk_id):
+        raise Http404("flight not in the flight file of the datafile")
+    try:
+        start = float(request.GET.get('start', '-inf'))
+        end = float(request.GET.get('end', 'inf'))
+        max_points = int(request.GET.get('max_points', 0))
+    except ValueError:
+        return HttpResponseBadRequest("invalid start, end or max_points")
+    if ('max_points' in request.GET and max_points < 1):
+        return HttpResponseBadRequest("invalid max_points")
+    rate = DoseRate.get(datafile, flight)
+    if ('start' in request.GET or 'end' in request.GET):
+        x = rate['time']
+        keep = (x >= start) & (x <= end)
+        rate = {k : v[keep] for k, v in rate.items()}
+    if ('max_points' in request.GET):
+        keep = downsampleIndices(rate['time'],
+                                 [rate['bas'], rate['haut'], rate['total']],
+                                 max_points)
+        rate = {k : v[keep] for k, v in rate.items()}
+    if (request.GET.get('encoding') == 'compact'):
+        rate = {k : b64Float32(v) for k, v in rate.items()}
+    else:
+        rate = {k : v.tolist() for k, v in rate.items()}
+        rate['time'] = ['0000-01-01 ' + t
+                        for t in formatDurations(rate['time'])]
     rate['from'] = flight.airport_from
     rate['to'] = flight.airport_to
-    rate['dev'] = str(device)
+    rate['dev'] = str(datafile.device_fk)
     return JsonResponse(rate)
 
 
+# fields of IntegratedDose and its flight used by search results
+search_fields = {
+    "flight_fk" : "flight_fk", "file_fk" : "datafile_fk",
+    "num" : "flight_fk__num", "total" : "dose",
+    "haut" : "haut_LET", "bas" : "bas_LET",
+    "from" : "flight_fk__airport_from", "to" : "flight_fk__airport_to",
+    "time_off" : "flight_fk__time_off", "time_on" : "flight_fk__time_on",
+    "device" : "datafile_fk__device_fk",
+}
+
+
+# queryset of the IntegratedDose matching the search parameters
+def search_idoses(params):
+    querry = search_querry("flight_fk__num__contains", params["num"]) \
+        & search_querry("flight_fk__airport_from__contains", params["dep"]) \
+        & search_querry("flight_fk__airport_to__contains", params["arr"])
+    if params["min"] != "":
+        date = dt.datetime.strptime(params['min'], "%Y-%m-%d")
+        querry &= Q(flight_fk__time_off__gte=date)
+    if params["max"] != "":
+        date = dt.datetime.strptime(params['max'], "%Y-%m-%d")
+        date = date.replace(hour=23, minute=59, second=59)
+        querry &= Q(flight_fk__time_off__lte=date)
+    dev_list = list(map(int, filter(None, params["dev"].split(','))))
+    querry &= Q(datafile_fk__device_fk__in=dev_list)
+    return IntegratedDose.objects.filter(querry)
+
+
+# dict of device labels : { device id : str(device) }
+def device_labels(ids):
+    devices = Device.objects.filter(id__in=ids).select_related('version_fk')
+    return {dev.id : str(dev) for dev in devices}
+
+
+# format a row of search_idoses values as a search result
+def search_row(row, devices):
+    elem = {key : row[field] for key, field in search_fields.items()}
+    elem["date"] = dt.datetime.strftime(row["flight_fk__time_off"], "%d/%m/%Y")
+    elem["off"] = dt.datetime.strftime(elem.pop("time_off"), "%d/%m/%Y %H:%M")
+    elem["on"] = dt.datetime.strftime(elem.pop("time_on"), "%d/%m/%Y %H:%M")
+    elem["device"] = devices[elem["device"]]
+    return elem
+
+
+# search_idoses values rows as columns of search results : times in
+# seconds since epoch, doses as numbers and device ids
+def search_columns(rows):
+    columns = {key : [row[field] for row in rows]
+               for key, field in search_fields.items()}
+    for key in ("time_off", "time_on"):
+        columns[key] = [(time - epoch) // dt.timedelta(seconds=1)
+                        for time in columns[key]]
+    for key in ("bas", "haut", "total"):
+        columns[key] = [float(dose) if dose is not None else None
+                        for dose in columns[key]]
+    return columns
+
+
+# columns of csv and excel exports of search results
+export_columns = ['device', 'num', 'from', 'to', 'date', 'off',
+                  'on', 'bas', 'haut', 'total']
+
+
+# file like object returning what is written, used to stream csv lines
+class Echo:
+    def write(self, value):
+        return value
+
+
+# keyset pagination cursor of a search_idoses values row, made of the
+# flight time_off (µs since epoch) and the IntegratedDose id
+def search_cursor(row):
+    us = (row["flight_fk__time_off"] - epoch) // dt.timedelta(microseconds=1)
+    return "%d-%d" % (us, row["id"])
+
+
+# filter search_idoses ordered by (time_off, id) after a search_cursor
+def search_after(idoses, cursor):
+    us, pk = map(int, cursor.split('-'))
+    time_off = epoch + dt.timedelta(microseconds=us)
+    return idoses.filter(Q(flight_fk__time_off__gt=time_off)
+                         | Q(flight_fk__time_off=time_off, id__gt=pk))
+
+
+# group label of a search_idoses values row for search statistics
+stats_groups = {
+    "all" : lambda row, devices : "all",
+    "device" : lambda row, devices : devices[row[0]],
+    "route" : lambda row, devices : row[1] + " - " + row[2],
+    "month" : lambda row, devices : row[3].strftime("%Y-%m"),
+}
+
+
+# box plot statistics of bas, haut and total doses of search results
+# grouped by stats_groups[group]
+def search_stats(idoses, group, devices):
+    rows = list(idoses.order_by().values_list(
+        'datafile_fk__device_fk', 'flight_fk__airport_from',
+        'flight_fk__airport_to', 'flight_fk__time_off',
+        'bas_LET', 'haut_LET', 'dose'))
+    labels = numpy.array([stats_groups[group](row, devices) for row in rows],
+                         dtype=object)
+    doses = numpy.array([row[4:] for row in rows], dtype=float) \
+        .reshape(len(rows), 3)
+    stats = []
+    for label in sorted(set(labels)):
+        values = doses[labels == label]
+        stats.append({"group" : label, "bas" : boxStats(values[:, 0]),
+                      "haut" : boxStats(values[:, 1]),
+                      "total" : boxStats(values[:, 2])})
+    return stats
+
+
+# GET parameters : search_idoses parameters and format json (with size,
+# after and encoding=compact for search_columns), stats, csv or excel
 @permission_required('main.view', 'login')
+@gzip_page
 def search_(request):
-    res = []
-    querry = search_querry("num__contains", request.GET["num"]) \
-        & search_querry("airport_from__contains", request.GET["dep"]) \
-        & search_querry("airport_to__contains", request.GET["arr"])
-    if request.GET["min"] != "":
-        date = dt.datetime.strptime(request.GET['min'], "%Y-%m-%d")
-        querry &= Q(time_off__gte=date)
-    if request.GET["max"] != "":
-        date = dt.datetime.strptime(request.GET['max'], "%Y-%m-%d")
-        date = date.replace(hour=23, minute=59, second=59)
-        querry &= Q(time_off__lte=date)
-    flights = Flight.objects.filter(querry)
-    dev_list = list(map(int, filter(None, request.GET["dev"].split(','))))
-    datafiles = DataFile.objects.filter(device_fk_id__in=dev_list).all()
-    idoses = IntegratedDose.objects.filter(
-        flight_fk__in=flights, datafile_fk__in=datafiles) \
-            .order_by('flight_fk__time_off').all()
-    for idose in idoses:
-        fl = idose.flight_fk
-        dev = idose.datafile_fk.device_fk
-        elem = {
-            "flight_fk" : fl.id, "file_fk" : idose.datafile_fk.id,
-            "num" : fl.num, "total" : idose.dose, 
-            "haut" : idose.haut_LET, "bas" : idose.bas_LET,
-            "from" : fl.airport_from, "to" : fl.airport_to,
-            "date" : dt.datetime.strftime(fl.time_off, "%d/%m/%Y"),
-            "off" : dt.datetime.strftime(fl.time_off, "%d/%m/%Y %H:%M"),
-            "on" : dt.datetime.strftime(fl.time_on, "%d/%m/%Y %H:%M"),
-            "device": str(dev),
-        }
-        res.append(elem)
-    df = pandas.DataFrame.from_records(res, columns=[
-        'device', 'num', 'from', 'to', 'date', 'off',
-        'on', 'bas', 'haut', 'total'])
+    idoses = search_idoses(request.GET).order_by('flight_fk__time_off', 'id')
+    devices = device_labels(
+        map(int, filter(None, request.GET["dev"].split(','))))
     forma = request.GET.get('format', 'json')
     if forma == 'json':
-        return JsonResponse({'res' : res})
-    elif forma == 'csv':
-        response = HttpResponse(content_type='text/csv')
+        # one page of results, the total count is given with the first one
+        try:
+            size = max(1, min(int(request.GET.get('size', 1000)), 10000))
+        except ValueError:
+            return HttpResponseBadRequest("invalid size")
+        page = idoses
+        ret = {}
+        if request.GET.get('after', '') != '':
+            try:
+                page = search_after(idoses, request.GET['after'])
+            except (ValueError, OverflowError):
+                return HttpResponseBadRequest("invalid after")
+        else:
+            ret['count'] = idoses.count()
+        rows = list(page.values('id', *search_fields.values())[:size + 1])
+        ret['next'] = search_cursor(rows[size - 1]) \
+            if len(rows) > size else None
+        if (request.GET.get('encoding') == 'compact'):
+            ret['res'] = search_columns(rows[:size])
+            ret['devices'] = devices
+        else:
+            ret['res'] = [search_row(row, devices) for row in rows[:size]]
+        return JsonResponse(ret)
+    elif forma == 'stats':
+        group = request.GET.get('group', 'all')
+        if group not in stats_groups:
+            return HttpResponseBadRequest("unknown group")
+        return JsonResponse({'stats' : search_stats(idoses, group, devices)})
+    res = (search_row(row, devices) for row in idoses
+           .values(*search_fields.values()).iterator(chunk_size=2000))
+    lines = itertools.chain([export_columns],
+                            ([r[c] for c in export_columns] for r in res))
+    if forma == 'csv':
+        writer = csv.writer(Echo(), lineterminator='\n')
+        response = StreamingHttpResponse(
+            (writer.writerow(line) for line in lines),
+            content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename=dose.csv'
-        df.to_csv(path_or_buf=response, index=False)
         return response
     elif forma == 'excel':
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet');
+        # write only workbook keeps only the current row in memory
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('Sheet1')
+        for line in lines:
+            ws.append(line)
+        xlsx = tempfile.TemporaryFile()
+        wb.save(xlsx)
+        xlsx.seek(0, 0)
+        response = FileResponse(xlsx, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         response['Content-Disposition'] = 'attachment; filename=dose.xlsx'
-        writer = pandas.ExcelWriter(response)
-        df.to_excel(writer, 'Sheet1', index=False)
-        writer.save()
         return response
 
 
@@ -358,7 +434,8 @@ def view_devices(request):
         if dev.version_fk is not None:
             key += "-" + dev.version_fk.version
         ord_dev[key] = ord_dev.get(key, []) + [dev]
-    return (render(request, "view_devices.html", {'devs' : ord_dev}))
+    return (render(request, "view_devices.html", {'devs' : ord_dev,
+                                                  'job' : get_job(request)}))
 
 
 # display list of all datafiles
@@ -368,26 +445,45 @@ def view_datafiles(request):
     return (render(request, "view_datafiles.html", ctxt))
 
 
-# display list of data in one datafiles
+# number of rows of a datafile displayed by page
+data_page_size = 500
+
+
+# display list of data in one datafiles by page (GET parameter page)
+# or download it with format=csv
 @permission_required('main.view', 'login')
 def view_data(request, id_datafile):
-    dfile = get_object_or_404(DataFile, pk=id_datafile)
-    dtype = dfile.device_fk.dtype
-    data = deviceDict[dtype].objects.filter(file_fk=dfile).all()
-    columns = deviceDict[dtype].metadata["columns"]
-    resData = []
-    coeff = None
-    if len(data) > 0:
-        coeff = Coefficient.objects.filter(device_fk=dfile.device_fk,
-                                           start__lte=data[0].time).last()
-    for d in data:
-        tmp = [d.time]
-        for col in columns:
-            tmp.append(getattr(d, col["attr"]))
-        tmp.append(d.flight_fk.num if d.flight_fk != None else "None")
-        resData.append(tmp)
-    ctxt = {"file" : dfile, "data" : resData, "coeff" : coeff,
-        "columns" : [col["name"] for col in columns]}
+    dfile = get_object_or_404(
+        DataFile.objects.select_related('device_fk__version_fk'),
+        pk=id_datafile)
+    data_dev = deviceDict[dfile.device_fk.dtype]
+    data = data_dev.objects.filter(file_fk=dfile)
+    columns = data_dev.metadata["columns"]
+    rows = data.order_by('time', 'id').values_list(
+        'time', *[col["attr"] for col in columns], 'flight_fk__num')
+    names = [col["name"] for col in columns] + ["flight"]
+    if (request.GET.get('format') == 'csv'):
+        lines = itertools.chain(
+            [["time utc"] + names],
+            ((row[0].strftime("%d/%m/%Y %H:%M:%S"),) + row[1:]
+             for row in rows.iterator(chunk_size=2000)))
+        writer = csv.writer(Echo(), lineterminator='\n')
+        response = StreamingHttpResponse(
+            (writer.writerow(line) for line in lines),
+            content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="%s.csv"' \
+            % dfile.filename
+        return response
+    page = Paginator(rows, data_page_size).get_page(request.GET.get('page'))
+    resData = [row[:-1] + (row[-1] if row[-1] is not None else "None",)
+               for row in page]
+    span = data.aggregate(first=Min('time'), last=Max('time'))
+    coeffs = []
+    if span['first'] is not None:
+        coeffs = [coeff for coeff, start, end in Coefficient.intervals(
+            dfile.device_fk_id, span['first'], span['last'])]
+    ctxt = {"file" : dfile, "data" : resData, "coeffs" : coeffs,
+        "page" : page, "columns" : names}
     return (render(request, "view_data.html", ctxt))
 
 
@@ -427,41 +523,49 @@ def view_flights(request, id_flightfile):
             if (len(dtype) == 2):
                 vers = DeviceVersion.objects.get(dtype=dev, version=dtype[1])
             file_ = request.FILES.getlist('datafile')[0]
-            datafile, err = save_data_file(file_, dev, flight_file, vers)
-            if (err != None):
-                errors = ["File : " + file_.name + " " + err]
-                return (render(request, "view_flights.html", 
-                    dict(errors=errors, **ctxt)))
-            l = idose_flights(datafile, flight_file.flight_set.all())
-            IntegratedDose.objects.bulk_create(l)
-            return (redirect('view_flights', id_flightfile))
+            job = stage_job(request.user,
+                            [(file_, dev, vers.id if vers else None)],
+                            flight_file=flight_file)
+            return (redirect(reverse('view_flights', args=[id_flightfile])
+                             + '?job=' + str(job.id)))
         else:
            return (redirect('login'))
     else:
-        return (render(request, "view_flights.html", ctxt))
+        return (render(request, "view_flights.html",
+                       dict(job=get_job(request), **ctxt)))
 
 
-# display data of one flight
+# display data of one flight, one table by datafile
 @permission_required('main.view', 'login')
 def view_flight(request, id_flight):
-    flight = get_object_or_404(Flight, pk=id_flight)
+    flight = get_object_or_404(Flight.objects.select_related('file_fk'),
+                               pk=id_flight)
+    idoses = {idose.datafile_fk_id : idose for idose in
+              IntegratedDose.objects.filter(flight_fk=flight)}
+    datafiles = {}
+    for datafile in DataFile.objects.filter(
+            flight_file_fk=flight.file_fk_id).select_related('device_fk'):
+        datafiles.setdefault(datafile.device_fk.dtype, {})[datafile.id] \
+            = datafile
     data = []
     for value in deviceList:
-        flightdata = value.objects.filter(flight_fk=id_flight)
-        if len(flightdata) != 0:
-            columns = value.metadata["columns"]
-            rows = []
-            for d in flightdata:
-                tmp = [d.time]
-                for col in columns:
-                    tmp.append(getattr(d, col["attr"]))
-                rows.append(tmp)
+        if value.__name__ not in datafiles:
+            continue
+        columns = value.metadata["columns"]
+        # the index on (file_fk, flight_fk, time) gives the rows in order
+        flightdata = value.objects.filter(
+            file_fk__in=list(datafiles[value.__name__]),
+            flight_fk=flight).order_by(
+            'file_fk', 'time', 'id').values_list(
+            'file_fk', 'time', *[col["attr"] for col in columns])
+        for file_id, rows in itertools.groupby(flightdata.iterator(),
+                                               key=lambda row: row[0]):
             data.append({
-                "device" : value.metadata["name"], "rows" : rows, 
-                "columns" : [col["name"] for col in columns], 
-                "idose" : IntegratedDose.objects.filter(
-                    datafile_fk=flightdata[0].file_fk,
-                    flight_fk=id_flight).first()
+                "device" : value.metadata["name"],
+                "file" : datafiles[value.__name__][file_id],
+                "rows" : [row[1:] for row in rows],
+                "columns" : [col["name"] for col in columns],
+                "idose" : idoses.get(file_id)
                 })
     ctxt = {"flight" : flight, "data" : data, "file" : flight.file_fk}
     return (render(request, "view_flight.html", ctxt))